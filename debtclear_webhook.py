@@ -4,21 +4,29 @@ DebtClear Simple Webhook Server
 Receives form submissions from Lovable → Generates LBA PDF → Sends via SendGrid
 """
 
-from fastapi import FastAPI, HTTPException, Request
+from fastapi import BackgroundTasks, FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from datetime import datetime, timedelta
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, ConfigDict, EmailStr
+import asyncio
+from bisect import bisect_right
+from datetime import date, datetime, timedelta
+from hashlib import blake2b
 import json
 import os
 import base64
 from pathlib import Path
 import logging
 
+import aiofiles
+import httpx
+from jinja2 import DictLoader, Environment, FileSystemBytecodeCache
+
 # Setup logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="DebtClear Webhook", version="1.0.0")
+app = FastAPI(title="DebtClear Webhook", version="1.0.0", default_response_class=ORJSONResponse)
 
 # Add CORS middleware
 app.add_middleware(
@@ -40,101 +48,77 @@ SENDGRID_API_KEY = os.getenv("SENDGRID_API_KEY")
 PDF_OUTPUT_DIR = Path("/tmp/debtclear_pdfs")
 PDF_OUTPUT_DIR.mkdir(exist_ok=True)
 
-# ===== SCHEMAS =====
+# Set PERSIST_LOCAL=0 when a downstream consumer (e.g. object storage)
+# takes the rendered letter instead of local /tmp
+PERSIST_LOCAL = os.getenv("PERSIST_LOCAL", "1") == "1"
+
+# In-process case store so lookups don't hit the filesystem.
+# Later will use a database / Redis.
+CASES: dict[str, dict] = {}
+
+# Shared async HTTP client - keeps connections warm across requests and
+# multiplexes concurrent outbound POSTs over one HTTP/2 TLS session
+_http = httpx.AsyncClient(
+    http2=True,
+    timeout=10.0,
+    headers={"Authorization": f"Bearer {SENDGRID_API_KEY}"},
+    limits=httpx.Limits(
+        max_keepalive_connections=20,
+        max_connections=100,
+        keepalive_expiry=60.0,
+    ),
+)
 
-class IntakeSubmission(BaseModel):
-    """Form submission from Lovable"""
-    client_email: str
-    client_name: str
-    client_business: str
-    debtor_name: str
-    debtor_address: str
-    debtor_type: str  # "business" or "individual"
-    amount_owed_gbp: float
-    invoice_date: str  # YYYY-MM-DD
-    due_date: str  # YYYY-MM-DD
-    description_of_debt: str
-    dpa_accepted: bool
+@app.on_event("shutdown")
+async def close_http_client():
+    await _http.aclose()
 
-class CaseData(BaseModel):
-    """Processed case data"""
-    case_id: str
-    client_email: str
-    debtor_name: str
-    amount_owed_gbp: float
-    statutory_interest_gbp: float
-    compensation_gbp: float
-    total_claim_gbp: float
-    lba_pdf_path: str
+# Outbound email batching: intakes push onto the queue and a worker
+# drains it, packing a window's worth of mail into one SendGrid request
+_EMAIL_QUEUE: asyncio.Queue = asyncio.Queue()
+_EMAIL_BATCH_MAX = 100
+_EMAIL_BATCH_WINDOW = 0.5  # seconds
+_email_worker_task = None
 
-# ===== UTILITIES =====
+@app.on_event("startup")
+async def start_email_worker():
+    global _email_worker_task
+    _email_worker_task = asyncio.create_task(_email_batch_worker())
 
-def calculate_statutory_claim(amount_gbp: float, due_date_str: str) -> dict:
-    """
-    Calculate statutory interest + compensation per UK Late Payment Act 1998
-    """
-    due_date = datetime.strptime(due_date_str, "%Y-%m-%d")
-    today = datetime.now()
-    days_overdue = max(0, (today - due_date).days)
-    
-    # Interest: 8% + BoE base rate (currently 4.75%) = 12.75% annual
-    annual_rate = 0.1275
-    daily_rate = annual_rate / 365
-    interest = round(amount_gbp * daily_rate * days_overdue * 100) / 100
-    
-    # Fixed compensation tiers
-    if amount_gbp < 1000:
-        compensation = 40
-    elif amount_gbp < 10000:
-        compensation = 70
-    else:
-        compensation = 100
-    
-    total_claim = amount_gbp + interest + compensation
-    
-    return {
-        "days_overdue": days_overdue,
-        "statutory_interest_gbp": interest,
-        "compensation_gbp": compensation,
-        "total_claim_gbp": total_claim
-    }
+@app.on_event("shutdown")
+async def stop_email_worker():
+    if _email_worker_task is not None:
+        _email_worker_task.cancel()
 
-def generate_lba_pdf(case_data: dict) -> str:
-    """
-    Generate LBA PDF (simple version using HTML to text)
-    Returns path to generated PDF
-    """
-    from datetime import datetime
-    
-    case_id = case_data["case_id"]
-    today = datetime.now()
-    
-    # Generate LBA text content
-    lba_content = f"""
+# ===== TEMPLATES =====
+
+# LBA letter body, compiled once at import. The bytecode cache lets even
+# cold workers skip the lex/parse step.
+LBA_TEXT = """
 LETTER BEFORE ACTION
-Reference: {case_id}
-Date: {today.strftime('%d %B %Y')}
+Reference: {{ case_id }}
+Date: {{ today }}
 
 FROM:
-{case_data['client_business']}
-{case_data['client_email']}
+{{ client_business }}
+{{ client_email }}
 
 TO:
-{case_data['debtor_name']}
-{case_data['debtor_address']}
+{{ debtor_name }}
+{{ debtor_address }}
 
 RE: FORMAL DEMAND FOR PAYMENT - UNPAID INVOICE
 
-Dear {case_data['debtor_name']},
+Dear {{ debtor_name }},
 
 This is a formal letter before action. This letter is issued in accordance with the Pre-Action Protocol for Debt Claims under the Civil Procedure Rules.
 
 AMOUNT OWED:
-Principal Amount: £{case_data['amount_owed_gbp']:,.2f}
-Statutory Interest (12.75% p.a.): £{case_data['statutory_interest_gbp']:,.2f}
-Fixed Compensation: £{case_data['compensation_gbp']:,.2f}
+Principal Amount: £{{ principal_str }}
+Statutory Interest (12.75% p.a.): £{{ interest_str }}
+Fixed Compensation: £{{ comp_str }}
 ──────────────────────────────
-TOTAL AMOUNT DUE: £{case_data['total_claim_gbp']:,.2f}
+TOTAL AMOUNT DUE: £{{ total_str }}
 
 LEGAL BASIS:
 This claim is made under the Late Payment of Commercial Debts (Interest) Act 1998, which automatically entitles us to statutory interest and compensation for late payment of commercial debts.
@@ -146,10 +130,10 @@ STATUTORY INTEREST:
 - Interest calculated from due date to today
 
 FIXED COMPENSATION:
-- Amount owed £1,000 - £9,999.99: £{case_data['compensation_gbp']:,.2f}
+- Amount owed £1,000 - £9,999.99: £{{ comp_str }}
 
 WHAT YOU MUST DO:
-You must pay the full amount of £{case_data['total_claim_gbp']:,.2f} within 30 days of this letter.
+You must pay the full amount of £{{ total_str }} within 30 days of this letter.
 
 Payment should be made to:
 Bank Details: [To be provided by client]
@@ -167,59 +151,225 @@ This letter is a formal notice. Failure to respond or pay will be used as eviden
 
 Yours faithfully,
 
-{case_data['client_business']}
+{{ client_business }}
 
 ---
 This letter has been prepared by DebtClear Ltd, a legal document preparation service.
 This is not legal advice. Please seek independent legal counsel if required.
 """
+
+_JINJA_CACHE_DIR = Path("/tmp/jinja_cache")
+_JINJA_CACHE_DIR.mkdir(exist_ok=True)
+
+# The template must come through the loader - from_string() bypasses the
+# bytecode cache. keep_trailing_newline preserves the letter's final
+# newline, matching the original f-string output byte for byte.
+_ENV = Environment(
+    loader=DictLoader({"lba": LBA_TEXT}),
+    autoescape=False,
+    auto_reload=False,
+    keep_trailing_newline=True,
+    bytecode_cache=FileSystemBytecodeCache(str(_JINJA_CACHE_DIR)),
+)
+_LBA_TMPL = _ENV.get_template("lba")
+
+# ===== SCHEMAS =====
+
+class IntakeSubmission(BaseModel):
+    """Form submission from Lovable"""
+    model_config = ConfigDict(extra="ignore")
+
+    client_email: EmailStr
+    client_name: str
+    client_business: str
+    debtor_name: str
+    debtor_address: str
+    debtor_type: str  # "business" or "individual"
+    amount_owed_gbp: float
+    invoice_date: date  # YYYY-MM-DD
+    due_date: date  # YYYY-MM-DD
+    description_of_debt: str
+    dpa_accepted: bool
+
+# ===== UTILITIES =====
+
+# Fixed compensation tiers per the Late Payment Act: <£1,000 → £40,
+# <£10,000 → £70, otherwise £100
+_TIER_BOUNDS = (1000, 10000)
+_TIER_COMP = (40, 70, 100)
+
+# Interest: 8% + BoE base rate (currently 4.75%) = 12.75% annual
+_DAILY_RATE = 0.1275 / 365.0
+
+# 1-entry cache for today's letter date, keyed by ordinal day
+_today_cache = (0, "")
+
+def _today_str(today: datetime) -> str:
+    """Format today as '%d %B %Y', recomputing only when the day changes"""
+    global _today_cache
+    ordinal = today.toordinal()
+    if _today_cache[0] != ordinal:
+        _today_cache = (ordinal, today.strftime('%d %B %Y'))
+    return _today_cache[1]
+
+def calculate_statutory_claim(amount_gbp: float, due_date: date) -> dict:
+    """
+    Calculate statutory interest + compensation per UK Late Payment Act 1998
+    """
+    days_overdue = max(0, (date.today() - due_date).days)
     
+    interest = round(amount_gbp * _DAILY_RATE * days_overdue, 2)
+
+    # Fixed compensation tiers - branchless indexed lookup
+    compensation = _TIER_COMP[bisect_right(_TIER_BOUNDS, amount_gbp)]
+
+    total_claim = amount_gbp + interest + compensation
+    
+    return {
+        "days_overdue": days_overdue,
+        "statutory_interest_gbp": interest,
+        "compensation_gbp": compensation,
+        "total_claim_gbp": total_claim
+    }
+
+async def generate_lba_pdf(case_data: dict) -> tuple:
+    """
+    Generate LBA PDF (simple version using HTML to text)
+    Returns (rendered content, path) - the file is only written when
+    PERSIST_LOCAL is set; without it the path is None
+    """
+    case_id = case_data["case_id"]
+    today = datetime.now()
+
+    # Render LBA text content from the precompiled template; format each
+    # monetary value once rather than per placeholder
+    lba_content = _LBA_TMPL.render(
+        **case_data,
+        today=_today_str(today),
+        principal_str=f"{case_data['amount_owed_gbp']:,.2f}",
+        interest_str=f"{case_data['statutory_interest_gbp']:,.2f}",
+        comp_str=f"{case_data['compensation_gbp']:,.2f}",
+        total_str=f"{case_data['total_claim_gbp']:,.2f}",
+    )
+
     # Save as text file (PDF generation would require additional library)
     # For MVP, we'll generate a text file and note that PDF conversion is needed
+    if not PERSIST_LOCAL:
+        logger.info(f"LBA generated (not persisted locally): {case_id}")
+        return lba_content, None
+
     txt_path = PDF_OUTPUT_DIR / f"{case_id}.txt"
-    with open(txt_path, "w") as f:
-        f.write(lba_content)
-    
+    async with aiofiles.open(txt_path, "w") as f:
+        await f.write(lba_content)
+
     logger.info(f"LBA generated: {txt_path}")
-    
-    return str(txt_path)
 
-def send_email_via_sendgrid(to_email: str, subject: str, html_body: str) -> bool:
+    return lba_content, str(txt_path)
+
+# Case ids whose letter file is known to exist on disk. Only hits are
+# remembered - a miss must re-check so a file written later (another
+# worker, or after this worker answered 404) is still found.
+_seen_case_files: set = set()
+
+def _case_exists(case_id: str) -> bool:
+    """
+    Existence check for the disk fallback, so polling clients don't cost
+    a stat() per GET once a case file has been seen.
     """
-    Send email via SendGrid API
+    if case_id in _seen_case_files:
+        return True
+    if (PDF_OUTPUT_DIR / f"{case_id}.txt").exists():
+        _seen_case_files.add(case_id)
+        return True
+    return False
+
+async def _persist_case(case_data: dict) -> None:
+    """Persist case data to disk so restarts can recover it"""
+    if not PERSIST_LOCAL:
+        return
+    json_path = PDF_OUTPUT_DIR / f"{case_data['case_id']}.json"
+    async with aiofiles.open(json_path, "w") as f:
+        await f.write(json.dumps(case_data))
+
+async def _dispatch_background(case_data: dict, to_email: str, subject: str, html_body: str) -> None:
+    """
+    Run the post-response work: hand the email to the batch worker and
+    persist the case data to disk.
+    """
+    _EMAIL_QUEUE.put_nowait((to_email, subject, html_body))
+    try:
+        await _persist_case(case_data)
+    except Exception as e:
+        logger.error(f"Case persistence failed: {str(e)}")
+
+async def _email_batch_worker() -> None:
+    """
+    Drain the email queue in batches: wait for the first message, then
+    collect up to _EMAIL_BATCH_MAX more within _EMAIL_BATCH_WINDOW.
+    Identical messages collapse into one bulk request; distinct ones are
+    posted concurrently.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await _EMAIL_QUEUE.get()]
+        deadline = loop.time() + _EMAIL_BATCH_WINDOW
+        while len(batch) < _EMAIL_BATCH_MAX:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(_EMAIL_QUEUE.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+
+        # Group by (subject, body) - SendGrid shares one content block
+        # across all personalizations in a request
+        groups: dict[tuple, list] = {}
+        for to_email, subject, html_body in batch:
+            groups.setdefault((subject, html_body), []).append(to_email)
+
+        results = await asyncio.gather(
+            *(
+                send_bulk_via_sendgrid(recipients, subject, html_body)
+                for (subject, html_body), recipients in groups.items()
+            ),
+            return_exceptions=True,
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                logger.error(f"Bulk email send failed: {str(result)}")
+
+async def send_bulk_via_sendgrid(recipients: list, subject: str, html_body: str) -> bool:
+    """
+    Send one email to many recipients in a single SendGrid request.
+    /v3/mail/send accepts up to 1000 personalizations per call, so one
+    round-trip covers the whole batch.
     """
     try:
-        import requests
-        
         url = "https://api.sendgrid.com/v3/mail/send"
-        headers = {
-            "Authorization": f"Bearer {SENDGRID_API_KEY}",
-            "Content-Type": "application/json"
-        }
-        
+
         payload = {
-            "personalizations": [{
-                "to": [{"email": to_email}],
-                "subject": subject
-            }],
+            "personalizations": [
+                {"to": [{"email": r}], "subject": subject} for r in recipients
+            ],
             "from": {"email": "noreply@debtclear.eu"},
             "content": [{
                 "type": "text/html",
                 "value": html_body
             }]
         }
-        
-        response = requests.post(url, json=payload, headers=headers, timeout=10)
-        
+
+        response = await _http.post(url, json=payload)
+
         if response.status_code in [200, 201, 202]:
-            logger.info(f"Email sent to {to_email}")
+            logger.info(f"Bulk email sent to {len(recipients)} recipient(s)")
             return True
         else:
             logger.error(f"SendGrid error: {response.status_code} - {response.text}")
             return False
-            
+
     except Exception as e:
-        logger.error(f"Email send failed: {str(e)}")
+        logger.error(f"Bulk email send failed: {str(e)}")
         return False
 
 # ===== ENDPOINTS =====
@@ -234,14 +384,14 @@ async def health():
     }
 
 @app.post("/api/intake")
-async def handle_intake(submission: IntakeSubmission):
+async def handle_intake(submission: IntakeSubmission, background_tasks: BackgroundTasks):
     """
     Handle Lovable form submission
     1. Validate debtor type (B2B only)
     2. Verify DPA acceptance
     3. Calculate statutory claim
     4. Generate LBA
-    5. Send email
+    5. Queue email (sent after the response)
     """
     
     logger.info(f"Intake submission: {submission.client_email}")
@@ -260,8 +410,13 @@ async def handle_intake(submission: IntakeSubmission):
             detail="Data Processing Agreement must be accepted to proceed."
         )
     
-    # Generate case ID
-    case_id = f"DC-{datetime.now().strftime('%Y%m%d')}-{abs(hash(submission.client_email)) % 10000:04d}"
+    # Generate case ID - blake2b is deterministic across restarts,
+    # unlike built-in str hashing (randomized per process). Reduced mod
+    # 10000 to keep the original fixed 4-digit suffix.
+    email_digest = int.from_bytes(
+        blake2b(submission.client_email.encode(), digest_size=2).digest(), "big"
+    )
+    case_id = f"DC-{datetime.now().strftime('%Y%m%d')}-{email_digest % 10000:04d}"
     
     # Calculate statutory claim
     claim_calc = calculate_statutory_claim(
@@ -278,8 +433,8 @@ async def handle_intake(submission: IntakeSubmission):
         "debtor_name": submission.debtor_name,
         "debtor_address": submission.debtor_address,
         "amount_owed_gbp": submission.amount_owed_gbp,
-        "invoice_date": submission.invoice_date,
-        "due_date": submission.due_date,
+        "invoice_date": submission.invoice_date.isoformat(),
+        "due_date": submission.due_date.isoformat(),
         "description_of_debt": submission.description_of_debt,
         "statutory_interest_gbp": claim_calc["statutory_interest_gbp"],
         "compensation_gbp": claim_calc["compensation_gbp"],
@@ -289,11 +444,14 @@ async def handle_intake(submission: IntakeSubmission):
     
     # Generate LBA PDF
     try:
-        lba_path = generate_lba_pdf(case_data)
+        lba_content, lba_path = await generate_lba_pdf(case_data)
         case_data["lba_pdf_path"] = lba_path
     except Exception as e:
         logger.error(f"PDF generation failed: {str(e)}")
         raise HTTPException(status_code=500, detail="LBA generation failed")
+
+    # Record the case in memory; persistence happens after the response
+    CASES[case_id] = case_data
     
     # Send email to client
     email_html = f"""
@@ -306,15 +464,16 @@ async def handle_intake(submission: IntakeSubmission):
     <p>Best regards,<br>DebtClear</p>
     """
     
-    email_sent = send_email_via_sendgrid(
+    # Persist + deliver after the response is sent, overlapping the disk
+    # write with the SendGrid round-trip
+    background_tasks.add_task(
+        _dispatch_background,
+        case_data,
         submission.client_email,
         f"Your Letter Before Action - {case_id}",
         email_html
     )
-    
-    if not email_sent:
-        logger.warning("Email send failed but case processed")
-    
+
     # Return success
     return {
         "status": "success",
@@ -325,24 +484,41 @@ async def handle_intake(submission: IntakeSubmission):
         "compensation_gbp": case_data["compensation_gbp"],
         "total_claim_gbp": case_data["total_claim_gbp"],
         "lba_generated": True,
-        "email_sent": email_sent,
-        "message": f"Case {case_id} created successfully. LBA prepared and email sent."
+        "email_sent": "queued",
+        "message": f"Case {case_id} created successfully. LBA prepared and email queued."
     }
 
 @app.get("/cases/{case_id}")
 async def get_case(case_id: str):
     """Retrieve case details"""
-    # In MVP, cases are stored in files. Later will use database.
-    pdf_file = PDF_OUTPUT_DIR / f"{case_id}.txt"
-    if not pdf_file.exists():
+    case = CASES.get(case_id)
+    if case is not None:
+        return {
+            "case_id": case_id,
+            "status": "lba_prepared",
+            "document": case["lba_pdf_path"]
+        }
+
+    # Fall back to disk for cases created before a restart
+    if not _case_exists(case_id):
         raise HTTPException(status_code=404, detail="Case not found")
-    
+
     return {
         "case_id": case_id,
         "status": "lba_prepared",
-        "document": str(pdf_file)
+        "document": str(PDF_OUTPUT_DIR / f"{case_id}.txt")
     }
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8001)
+    # uvloop + httptools for a faster event loop; one worker per CPU so
+    # concurrent intakes run in parallel past the GIL
+    uvicorn.run(
+        "debtclear_webhook:app",
+        host="0.0.0.0",
+        port=8001,
+        workers=os.cpu_count(),
+        loop="uvloop",
+        http="httptools",
+        log_level="info",
+    )